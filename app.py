@@ -14,15 +14,70 @@ st.set_page_config(
 )
 
 # Initialize data processor
-@st.cache_data
-def load_data():
-    """Load and process all data files"""
+@st.cache_resource
+def load_frames():
+    """Load and process all data files (shared in-process, treat as read-only)"""
     processor = DataProcessor()
     return processor.load_all_data()
 
+@st.cache_resource
+def load_lookups(_frames):
+    """Derived lookups (sidecar-backed) and metadata/ID indexes, built once per process (shared, read-only)"""
+    enhancer_metadata, peak_data, hof_enhancers, data_key = _frames
+    processor = DataProcessor()
+    derived = processor.load_derived_data(enhancer_metadata, peak_data, hof_enhancers, data_key)
+    meta_by_enh = processor.index_metadata_by_enhancer(enhancer_metadata)
+    hof_ids = pd.Index(hof_enhancers['enhancer_id'].unique()) if 'enhancer_id' in hof_enhancers.columns else pd.Index([])
+    # Enhancers listed when no metadata filter is active: HOF enhancers that have metadata
+    default_ids = hof_ids[hof_ids.isin(enhancer_metadata['enhancer_id'])] if not enhancer_metadata.empty else hof_ids
+    return derived, meta_by_enh, hof_ids, default_ids
+
+@st.cache_data
+def load_derived(_frames):
+    """Small derived values copied per session: filter option lists and the enhancer summary table"""
+    derived, _, _, _ = load_lookups(_frames)
+    return derived.filter_options, derived.enhancer_summary
+
+@st.cache_resource
+def index_peaks_by_enhancer(_peak_data):
+    """Group peak data by enhancer once so lookups are a dict access (shared, read-only)"""
+    processor = DataProcessor()
+    return processor.group_peaks_by_enhancer(_peak_data)
+
+@st.cache_resource
+def _viz():
+    """Shared visualization generator with cell type colors fixed from the ordered categories"""
+    _, peak_data, _, _ = load_frames()
+    viz_generator = VisualizationGenerator()
+    if 'cell_type' in peak_data.columns:
+        viz_generator.assign_cell_type_colors(peak_data['cell_type'].cat.categories)
+    return viz_generator
+
+def get_enhancer_peak_data(enhancer_id, cell_type="All"):
+    """Peak rows of one enhancer, optionally restricted to a single cell type"""
+    _, peak_data, _, _ = load_frames()
+    enhancer_peak_data = index_peaks_by_enhancer(peak_data).get(enhancer_id, peak_data.iloc[0:0])
+    
+    if cell_type != "All":
+        enhancer_peak_data = enhancer_peak_data[enhancer_peak_data['cell_type'] == cell_type]
+    
+    return enhancer_peak_data
+
+# Bounded: each entry is a pickled figure with up to one 512-point track per cell type
+@st.cache_data(max_entries=64)
+def build_peak_fig(enhancer_id, cell_type):
+    """Build the peak accessibility figure, cached per (enhancer_id, cell_type)"""
+    viz_generator = _viz()
+    return viz_generator.create_peak_visualization(get_enhancer_peak_data(enhancer_id, cell_type), enhancer_id)
+
 # Load data
 try:
-    enhancer_metadata, peak_data, hof_enhancers = load_data()
+    frames = load_frames()
+    enhancer_metadata, peak_data, hof_enhancers, _ = frames
+    derived, META_BY_ENH, HOF_IDS, DEFAULT_IDS = load_lookups(frames)
+    ENH_STATS, TOP_CELL_TYPES, IMAGING_BY_ENH = derived.enhancer_stats, derived.top_cell_types, derived.imaging_urls
+    filter_options, ENHANCER_SUMMARY = load_derived(frames)
+    index_peaks_by_enhancer(peak_data)  # Build the per-enhancer groups up front
     st.success("App is loaded!")
 except Exception as e:
     st.error(f"❌ Error loading data: {str(e)}")
@@ -36,28 +91,8 @@ st.markdown("---")
 st.header("🔍 Enhancer Selection and Filters")
 st.markdown("Choose an enhancer and apply additional filters to focus your analysis")
 
-# Get unique values for filters from the appropriate sources
-unique_enhancers = sorted(hof_enhancers['enhancer_id'].unique()) if 'enhancer_id' in hof_enhancers.columns else []
-
-# Get filter values from the metadata (feather file) since that's where cargo, experiment, and gene info is stored
-unique_cargos = []
-unique_experiments = [] 
-unique_genes = []
-
-if not enhancer_metadata.empty:
-    # Filter metadata to only include enhancers that are in our HOF enhancers list
-    relevant_metadata = enhancer_metadata[enhancer_metadata['enhancer_id'].isin(unique_enhancers)]
-    
-    unique_cargos = sorted([x for x in relevant_metadata['cargo'].dropna().unique() if x != ''])
-    unique_experiments = sorted([x for x in relevant_metadata['experiment'].dropna().unique() if x != ''])
-    unique_genes = sorted([x for x in relevant_metadata['proximal_gene'].dropna().unique() if x != ''])
-# Sort cell types numerically by their leading numbers (1-34)
-import re
-def extract_cell_type_number(cell_type):
-    match = re.match(r'^(\d+)', str(cell_type))
-    return int(match.group(1)) if match else 999
-
-unique_cell_types = sorted(peak_data['cell_type'].unique(), key=extract_cell_type_number) if not peak_data.empty else []
+# Filter option lists are precomputed at load time
+unique_enhancers, unique_cargos, unique_experiments, unique_genes, unique_cell_types = filter_options
 
 # Main filter controls in columns
 col1, col2, col3, col4, col5 = st.columns(5)
@@ -116,31 +151,34 @@ with col3:
 if selected_enhancer != "All":
     # Filter to specific enhancer
     filtered_enhancers = hof_enhancers[hof_enhancers['enhancer_id'] == selected_enhancer].copy()
-    relevant_metadata = enhancer_metadata[enhancer_metadata['enhancer_id'] == selected_enhancer] if not enhancer_metadata.empty else pd.DataFrame()
 else:
     # Start with all HOF enhancers
-    enhancer_ids_to_include = set(hof_enhancers['enhancer_id'].unique())
+    enhancer_ids_to_include = HOF_IDS
     
-    # Apply metadata-based filters to narrow down the enhancer list
-    if not enhancer_metadata.empty:
-        filtered_metadata = enhancer_metadata.copy()
+    if selected_cargo == selected_experiment == selected_gene == "All":
+        # No metadata filter active: skip the metadata scan entirely
+        enhancer_ids_to_include = DEFAULT_IDS
+    elif not enhancer_metadata.empty:
+        # Apply metadata-based filters as a single boolean mask over the metadata
+        mask = enhancer_metadata['enhancer_id'].isin(HOF_IDS).to_numpy(copy=True)
         
         if selected_cargo != "All":
-            filtered_metadata = filtered_metadata[filtered_metadata['cargo'] == selected_cargo]
+            mask &= enhancer_metadata['cargo'].values == selected_cargo
         
         if selected_experiment != "All":
-            filtered_metadata = filtered_metadata[filtered_metadata['experiment'] == selected_experiment]
+            mask &= enhancer_metadata['experiment'].values == selected_experiment
             
         if selected_gene != "All":
-            filtered_metadata = filtered_metadata[filtered_metadata['proximal_gene'] == selected_gene]
+            mask &= enhancer_metadata['proximal_gene'].values == selected_gene
         
-        # Get the enhancer IDs that match the metadata filters
-        matching_enhancer_ids = set(filtered_metadata['enhancer_id'].unique())
-        enhancer_ids_to_include = enhancer_ids_to_include.intersection(matching_enhancer_ids)
+        # Get the HOF enhancer IDs that match the metadata filters
+        enhancer_ids_to_include = enhancer_metadata.loc[mask, 'enhancer_id'].unique()
     
-    # Filter HOF enhancers to only include those that pass metadata filters
-    filtered_enhancers = hof_enhancers[hof_enhancers['enhancer_id'].isin(list(enhancer_ids_to_include))].copy()
-    relevant_metadata = enhancer_metadata[enhancer_metadata['enhancer_id'].isin(list(enhancer_ids_to_include))] if not enhancer_metadata.empty else pd.DataFrame()
+    # Filter HOF enhancers to only include those that pass metadata filters,
+    # matching on integer category codes so the membership test stays in numpy
+    hof_enhancer_ids = hof_enhancers['enhancer_id']
+    codes_wanted = hof_enhancer_ids.cat.categories.get_indexer(np.asarray(enhancer_ids_to_include))
+    filtered_enhancers = hof_enhancers[np.isin(hof_enhancer_ids.cat.codes.to_numpy(), codes_wanted[codes_wanted >= 0])]
 
 # Display results
 if filtered_enhancers.empty:
@@ -150,60 +188,41 @@ elif selected_enhancer == "All":
     st.markdown("### Available Enhancers")
     
     # Show summary table of all enhancers
-    enhancer_summary = []
-    for idx, enhancer_row in filtered_enhancers.iterrows():
-        enhancer_id = enhancer_row.get('enhancer_id', 'Unknown')
-        enhancer_peaks = peak_data[peak_data['enhancer_id'] == enhancer_id]
-        
-        if not enhancer_peaks.empty:
-            enhancer_summary.append({
-                'Enhancer ID': enhancer_id,
-                'Chromosome': enhancer_peaks.iloc[0]['chr'],
-                'Start': f"{enhancer_peaks.iloc[0]['start']:,}",
-                'End': f"{enhancer_peaks.iloc[0]['end']:,}",
-                'Length (bp)': f"{enhancer_peaks.iloc[0]['end'] - enhancer_peaks.iloc[0]['start']:,}",
-                'Cell Types': enhancer_peaks['cell_type'].nunique(),
-                'Mean Accessibility': f"{enhancer_peaks['accessibility_score'].mean():.4f}",
-                'Max Accessibility': f"{enhancer_peaks['accessibility_score'].max():.4f}"
-            })
+    summary_df = ENHANCER_SUMMARY.loc[ENHANCER_SUMMARY.index.intersection(list(enhancer_ids_to_include))]
     
-    if enhancer_summary:
-        summary_df = pd.DataFrame(enhancer_summary)
+    if not summary_df.empty:
         st.dataframe(summary_df, use_container_width=True)
 else:
-    # Process selected enhancer
-    for idx, enhancer_row in filtered_enhancers.iterrows():
-        enhancer_id = enhancer_row.get('enhancer_id', 'Unknown')
-        
+    # Process selected enhancer (iterate plain IDs; no per-row Series boxing)
+    enhancer_ids = filtered_enhancers['enhancer_id'].tolist()
+    for enhancer_id in enhancer_ids:
         # Create expandable section for each enhancer
-        with st.expander(f"🎯 **{enhancer_id}**", expanded=(len(filtered_enhancers) == 1)):
+        with st.expander(f"🎯 **{enhancer_id}**", expanded=(len(enhancer_ids) == 1)):
             
             # 1. METADATA DISPLAY (First) - Use authentic metadata from feather file
             st.markdown("### 📋 Enhancer Metadata")
             
             # Get the actual metadata for this enhancer from the feather file
-            enhancer_metadata = relevant_metadata[relevant_metadata['enhancer_id'] == enhancer_id] if not relevant_metadata.empty else pd.DataFrame()
+            meta_row = META_BY_ENH.loc[enhancer_id] if enhancer_id in META_BY_ENH.index else None
             
             col1, col2 = st.columns(2)
             
             with col1:
                 st.markdown("**Experimental Information:**")
-                if not enhancer_metadata.empty:
-                    # Show actual metadata from your feather file
-                    for _, meta_row in enhancer_metadata.iterrows():
-                        if pd.notna(meta_row.get('cargo')) and meta_row.get('cargo') != '':
-                            st.markdown(f"- **Cargo:** {meta_row['cargo']}")
-                        if pd.notna(meta_row.get('experiment')) and meta_row.get('experiment') != '':
-                            st.markdown(f"- **Experiment Type:** {meta_row['experiment']}")
-                        if pd.notna(meta_row.get('proximal_gene')) and meta_row.get('proximal_gene') != '':
-                            st.markdown(f"- **Proximal Gene:** {meta_row['proximal_gene']}")
-                        break  # Just show the first match for now
+                if meta_row is not None:
+                    # Show actual metadata from your feather file (first match)
+                    if pd.notna(meta_row.get('cargo')) and meta_row.get('cargo') != '':
+                        st.markdown(f"- **Cargo:** {meta_row['cargo']}")
+                    if pd.notna(meta_row.get('experiment')) and meta_row.get('experiment') != '':
+                        st.markdown(f"- **Experiment Type:** {meta_row['experiment']}")
+                    if pd.notna(meta_row.get('proximal_gene')) and meta_row.get('proximal_gene') != '':
+                        st.markdown(f"- **Proximal Gene:** {meta_row['proximal_gene']}")
                 else:
                     st.markdown("- No metadata available for this enhancer")
             
             with col2:
                 # Get genomic coordinates from peak data
-                enhancer_peaks = peak_data[peak_data['enhancer_id'] == enhancer_id]
+                enhancer_peaks = get_enhancer_peak_data(enhancer_id)
                 if not enhancer_peaks.empty:
                     chr_info = enhancer_peaks.iloc[0]['chr']
                     start_pos = enhancer_peaks.iloc[0]['start']
@@ -227,56 +246,21 @@ else:
             # 2. EMBEDDED IMAGING (Second) - Contact Sheets and Neuroglancer
             st.markdown("### 🖼️ Imaging Visualization")
             
-            # Get all imaging data for this enhancer from the metadata dataframe
-            if not relevant_metadata.empty:
-                # Get the metadata row for this specific enhancer
-                enhancer_meta_row = relevant_metadata[relevant_metadata['enhancer_id'] == enhancer_id]
-                
-                if not enhancer_meta_row.empty:
-                    # Extract multiple visualization URLs from the authentic metadata
-                    meta_row = enhancer_meta_row.iloc[0]
-                    image_link = meta_row.get('Image_link', '') if pd.notna(meta_row.get('Image_link')) else ''
-                    neuroglancer_1 = meta_row.get('Neuroglancer 1', '') if pd.notna(meta_row.get('Neuroglancer 1')) else ''
-                    neuroglancer_3 = meta_row.get('Neuroglancer 3', '') if pd.notna(meta_row.get('Neuroglancer 3')) else ''
-                    viewer_link = meta_row.get('neuroglancer_url', '') if pd.notna(meta_row.get('neuroglancer_url')) else ''
-                    coronal_mip = meta_row.get('Coronal_MIP', '') if pd.notna(meta_row.get('Coronal_MIP')) else ''
-                    sagittal_mip = meta_row.get('Sagittal_MIP', '') if pd.notna(meta_row.get('Sagittal_MIP')) else ''
-                else:
-                    # No metadata found for this enhancer
-                    image_link = neuroglancer_1 = neuroglancer_3 = viewer_link = coronal_mip = sagittal_mip = ''
-            else:
-                # No metadata available
-                image_link = neuroglancer_1 = neuroglancer_3 = viewer_link = coronal_mip = sagittal_mip = ''
-            
-            # Collect all valid URLs
-            imaging_urls = []
-            if image_link and image_link.startswith('http'):
-                imaging_urls.append(('Contact Sheet', image_link))
-            if neuroglancer_1 and neuroglancer_1.startswith('http'):
-                imaging_urls.append(('Neuroglancer 1', neuroglancer_1))
-            if neuroglancer_3 and neuroglancer_3.startswith('http'):
-                imaging_urls.append(('Neuroglancer 3', neuroglancer_3))
-            if viewer_link and viewer_link.startswith('http'):
-                imaging_urls.append(('Viewer', viewer_link))
-            if coronal_mip and coronal_mip.startswith('http'):
-                imaging_urls.append(('Coronal MIP', coronal_mip))
-            if sagittal_mip and sagittal_mip.startswith('http'):
-                imaging_urls.append(('Sagittal MIP', sagittal_mip))
+            # Valid imaging URLs for this enhancer were collected at load time
+            imaging_urls = IMAGING_BY_ENH.get(enhancer_id, [])
             
             if imaging_urls:
-                # Display all available imaging modalities as large embedded viewers
-                for i, (title, url) in enumerate(imaging_urls):
-                    st.markdown(f"#### {title}")
-                    
-                    # Embed as large, wide iframe
-                    st.markdown(
+                # Display all available imaging modalities as large embedded viewers,
+                # emitted as one HTML block instead of one element per title/iframe/separator
+                html_parts = []
+                for title, url in imaging_urls:
+                    html_parts.append(
+                        f'<h4>{title}</h4>'
                         f'<iframe src="{url}" width="100%" height="700" frameborder="0" '
-                        f'style="border: 2px solid #0066cc; border-radius: 8px; margin: 10px 0;"></iframe>', 
-                        unsafe_allow_html=True
+                        f'style="border: 2px solid #0066cc; border-radius: 8px; margin: 10px 0;"></iframe>'
                     )
-                    
-                    if i < len(imaging_urls) - 1:  # Add separator between viewers
-                        st.markdown("---")
+                
+                st.markdown('<hr>'.join(html_parts), unsafe_allow_html=True)
             else:
                 st.info("No imaging visualizations available for this enhancer")
             
@@ -286,26 +270,32 @@ else:
             st.markdown("### 📈 Peak Accessibility Profile Across Cell Types")
             
             # Filter peak data for this enhancer
-            enhancer_peak_data = peak_data[peak_data['enhancer_id'] == enhancer_id].copy()
+            enhancer_peak_data = get_enhancer_peak_data(enhancer_id, selected_cell_type)
             
             if selected_cell_type != "All":
-                enhancer_peak_data = enhancer_peak_data[enhancer_peak_data['cell_type'] == selected_cell_type]
                 st.info(f"Showing data filtered for cell type: **{selected_cell_type}**")
             
             if not enhancer_peak_data.empty:
                 try:
                     # Generate pyGenomeTracks-style visualization
-                    viz_generator = VisualizationGenerator()
-                    fig = viz_generator.create_peak_visualization(enhancer_peak_data, enhancer_id)
+                    fig = build_peak_fig(enhancer_id, selected_cell_type)
                     st.plotly_chart(fig, use_container_width=True)
                     
                     # Summary statistics
                     st.markdown("### 📊 Accessibility Statistics")
                     
-                    cell_types_count = enhancer_peak_data['cell_type'].nunique()
-                    max_accessibility = enhancer_peak_data['accessibility_score'].max()
-                    mean_accessibility = enhancer_peak_data['accessibility_score'].mean()
-                    std_accessibility = enhancer_peak_data['accessibility_score'].std()
+                    if selected_cell_type == "All":
+                        # Unfiltered stats are precomputed per enhancer
+                        enhancer_stats = ENH_STATS.loc[enhancer_id]
+                        cell_types_count = int(enhancer_stats['cell_types'])
+                        max_accessibility = enhancer_stats['max']
+                        mean_accessibility = enhancer_stats['mean']
+                        std_accessibility = enhancer_stats['std']
+                    else:
+                        cell_types_count = enhancer_peak_data['cell_type'].nunique()
+                        max_accessibility = enhancer_peak_data['accessibility_score'].max()
+                        mean_accessibility = enhancer_peak_data['accessibility_score'].mean()
+                        std_accessibility = enhancer_peak_data['accessibility_score'].std()
                     
                     col1, col2, col3, col4 = st.columns(4)
                     with col1:
@@ -320,12 +310,7 @@ else:
                     # Top cell types by accessibility
                     if cell_types_count > 1:
                         st.markdown("**Top Cell Types by Mean Accessibility:**")
-                        top_cell_types = (enhancer_peak_data.groupby('cell_type')['accessibility_score']
-                                        .mean()
-                                        .sort_values(ascending=False)
-                                        .head(5))
-                        
-                        for i, (cell_type, score) in enumerate(top_cell_types.items(), 1):
+                        for i, (cell_type, score) in enumerate(TOP_CELL_TYPES.get(enhancer_id, []), 1):
                             st.markdown(f"{i}. **{cell_type}**: {score:.4f}")
                     
                 except Exception as e:
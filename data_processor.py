@@ -1,16 +1,45 @@
 import pandas as pd
+import pyarrow as pa
 import pyarrow.feather as feather
 import numpy as np
 import os
+import tempfile
+import json
+import hashlib
+from collections import namedtuple
 import streamlit as st
 
+# Option lists for the filter selectboxes, computed once per data load
+FilterOptions = namedtuple('FilterOptions', ['enhancers', 'cargos', 'experiments', 'genes', 'cell_types'])
+
+# Derived lookups persisted in the sidecar cache (see load_derived_data)
+DerivedData = namedtuple(
+    'DerivedData', ['filter_options', 'enhancer_stats', 'enhancer_summary', 'top_cell_types', 'imaging_urls']
+)
+
 class DataProcessor:
     def __init__(self):
         self.csv_path = "attached_assets/HOF_enhancers_peak_data_1751042112619.csv"
         self.feather_path = "attached_assets/Enhancer_and_experiment_metadata_1751042144891.feather"
+        self.metadata_path = "attached_assets/Enhancer_and_experiment_metadata_1751044039206.feather"
+        
+        # Sidecar files with precomputed lookups, keyed by the input files;
+        # bump the version when the derived data layout changes
+        self.cache_dir = "cache"
+        self.derived_cache_version = 3
+        
+        # Only these columns are used by the app; everything else stays on disk
+        self.peak_columns = ['enhancer_id', 'chr', 'start', 'end', 'cell_type', 'position_index', 'accessibility_score']
+        self.metadata_columns = [
+            'Enhancer_ID', 'Cargo', 'Experiment_Type', 'Proximal_Gene', 'Viewer Link',
+            'Image_link', 'Neuroglancer 1', 'Neuroglancer 3', 'Coronal_MIP', 'Sagittal_MIP'
+        ]
     
     def load_all_data(self):
-        """Load all data files and return processed datasets"""
+        """Load all data files and return processed datasets plus the derived cache key"""
+        
+        # Key the derived sidecar on the input files as they are before reading them
+        data_key = self.derived_cache_key()
         
         # Load peak data from CSV
         peak_data = self.load_peak_data()
@@ -21,17 +50,24 @@ class DataProcessor:
         # Extract Hall of Fame enhancers
         hof_enhancers = self.extract_hof_enhancers(enhancer_metadata, peak_data)
         
-        return enhancer_metadata, peak_data, hof_enhancers
+        # Categorical IDs and filter columns let isin() and equality filters compare integer codes
+        metadata_categoricals = ['enhancer_id', 'cargo', 'experiment', 'proximal_gene']
+        enhancer_metadata = enhancer_metadata.astype(
+            {col: 'category' for col in metadata_categoricals if col in enhancer_metadata.columns}
+        )
+        if 'enhancer_id' in hof_enhancers.columns:
+            hof_enhancers = hof_enhancers.astype({'enhancer_id': 'category'})
+        
+        return enhancer_metadata, peak_data, hof_enhancers, data_key
     
     def load_peak_data(self):
         """Load and process the peak accessibility data"""
         try:
-            # Load CSV data
-            df = pd.read_csv(self.csv_path)
+            # Load CSV data, parsing only the columns we use
+            df = pd.read_csv(self.csv_path, usecols=lambda col: col in self.peak_columns)
             
             # Validate expected columns
-            expected_cols = ['enhancer_id', 'chr', 'start', 'end', 'cell_type', 'position_index', 'accessibility_score']
-            missing_cols = [col for col in expected_cols if col not in df.columns]
+            missing_cols = [col for col in self.peak_columns if col not in df.columns]
             
             if missing_cols:
                 st.warning(f"Missing columns in peak data: {missing_cols}")
@@ -59,7 +95,7 @@ class DataProcessor:
                     st.warning(f"Found {invalid_coords.sum()} records with invalid genomic coordinates")
                     df = df[~invalid_coords]
             
-            return df
+            return self.optimize_peak_dtypes(df)
             
         except FileNotFoundError:
             st.error(f"Peak data file not found: {self.csv_path}")
@@ -68,13 +104,44 @@ class DataProcessor:
             st.error(f"Error loading peak data: {str(e)}")
             return pd.DataFrame()
     
+    def optimize_peak_dtypes(self, df):
+        """Downcast peak data to categorical labels and 32-bit numerics"""
+        compact_dtypes = {
+            'enhancer_id': 'category',
+            'cell_type': 'category',
+            'chr': 'category',
+            'start': 'int32',
+            'end': 'int32',
+            'position_index': 'int32',
+            'accessibility_score': 'float32'
+        }
+        df = df.astype({col: dtype for col, dtype in compact_dtypes.items() if col in df.columns})
+        
+        if 'cell_type' in df.columns:
+            # Order cell types numerically by their leading numbers (1-34) once, at load time
+            categories = df['cell_type'].cat.categories
+            numbers = categories.str.extract(r'^(\d+)')[0].fillna('999').astype(int)
+            order = np.argsort(numbers.values, kind='stable')
+            df['cell_type'] = df['cell_type'].cat.reorder_categories(categories[order], ordered=True)
+        
+        return df
+    
     def load_metadata(self):
         """Load enhancer metadata from feather file"""
         try:
             # Try to read the actual feather file
-            feather_path = "attached_assets/Enhancer_and_experiment_metadata_1751044039206.feather"
+            feather_path = self.metadata_path
             if os.path.exists(feather_path):
-                df = feather.read_feather(feather_path)
+                # Project to the columns we use so the rest are never decoded
+                try:
+                    with pa.memory_map(feather_path) as source:
+                        available_cols = pa.ipc.open_file(source).schema.names
+                    columns = [col for col in self.metadata_columns if col in available_cols]
+                    table = feather.read_table(feather_path, columns=columns)
+                except pa.ArrowInvalid:
+                    # Feather V1 files are not Arrow IPC files and cannot be probed; read them whole
+                    table = feather.read_table(feather_path)
+                df = table.to_pandas(split_blocks=True, self_destruct=True)
                 
                 # Rename columns to match expected names and filter for Hall of Fame enhancers
                 if 'Enhancer_ID' in df.columns:
@@ -169,6 +236,230 @@ class DataProcessor:
         
         return hof_metadata.sort_values('enhancer_id')
     
+    def build_filter_options(self, enhancer_metadata, peak_data, hof_enhancers):
+        """Precompute the sorted option lists for the filter controls"""
+        unique_enhancers = sorted(hof_enhancers['enhancer_id'].unique()) if 'enhancer_id' in hof_enhancers.columns else []
+        
+        # Cargo, experiment and gene values live in the metadata (feather file)
+        unique_cargos = []
+        unique_experiments = []
+        unique_genes = []
+        
+        if not enhancer_metadata.empty:
+            # Only offer values for enhancers that are in our HOF enhancers list
+            relevant_metadata = enhancer_metadata[enhancer_metadata['enhancer_id'].isin(unique_enhancers)]
+            
+            # The columns are categorical, so the distinct values are just the used categories
+            unique_cargos = sorted([x for x in relevant_metadata['cargo'].cat.remove_unused_categories().cat.categories if x != ''])
+            unique_experiments = sorted([x for x in relevant_metadata['experiment'].cat.remove_unused_categories().cat.categories if x != ''])
+            unique_genes = sorted([x for x in relevant_metadata['proximal_gene'].cat.remove_unused_categories().cat.categories if x != ''])
+        
+        # Cell type categories are already in numeric order
+        unique_cell_types = list(peak_data['cell_type'].cat.categories) if not peak_data.empty else []
+        
+        return FilterOptions(unique_enhancers, unique_cargos, unique_experiments, unique_genes, unique_cell_types)
+    
+    def index_metadata_by_enhancer(self, enhancer_metadata):
+        """Index the first metadata row of each enhancer by enhancer_id"""
+        if enhancer_metadata.empty:
+            return pd.DataFrame()
+        
+        return enhancer_metadata.drop_duplicates('enhancer_id').set_index('enhancer_id')
+    
+    def build_imaging_urls(self, enhancer_metadata):
+        """Collect the valid (title, url) imaging links for each enhancer"""
+        if enhancer_metadata.empty:
+            return {}
+        
+        # Imaging columns and their display titles, in display order
+        imaging_columns = {
+            'Image_link': 'Contact Sheet',
+            'Neuroglancer 1': 'Neuroglancer 1',
+            'Neuroglancer 3': 'Neuroglancer 3',
+            'neuroglancer_url': 'Viewer',
+            'Coronal_MIP': 'Coronal MIP',
+            'Sagittal_MIP': 'Sagittal MIP'
+        }
+        columns = [col for col in imaging_columns if col in enhancer_metadata.columns]
+        titles = [imaging_columns[col] for col in columns]
+        
+        # Use the first metadata row of each enhancer, like the metadata display
+        first_rows = enhancer_metadata.drop_duplicates('enhancer_id')[['enhancer_id'] + columns]
+        
+        imaging_by_enh = {}
+        for enhancer_id, *urls in first_rows.itertuples(index=False, name=None):
+            imaging_by_enh[enhancer_id] = [
+                (title, url) for title, url in zip(titles, urls)
+                if isinstance(url, str) and url.startswith('http')
+            ]
+        
+        return imaging_by_enh
+    
+    def group_peaks_by_enhancer(self, peak_data):
+        """Split peak data into per-enhancer frames keyed by enhancer_id"""
+        if peak_data.empty:
+            return {}
+        
+        return {
+            enhancer_id: group
+            for enhancer_id, group in peak_data.groupby('enhancer_id', sort=False, observed=True)
+        }
+    
+    def build_enhancer_stats(self, peak_data):
+        """Coordinates, cell type count and accessibility max/mean/std for every enhancer in one grouped pass"""
+        if peak_data.empty:
+            return pd.DataFrame(columns=['chr', 'start', 'end', 'cell_types', 'mean', 'max', 'std'])
+        
+        return peak_data.groupby('enhancer_id', observed=True).agg(
+            chr=('chr', 'first'),
+            start=('start', 'first'),
+            end=('end', 'first'),
+            cell_types=('cell_type', 'nunique'),
+            mean=('accessibility_score', 'mean'),
+            max=('accessibility_score', 'max'),
+            std=('accessibility_score', 'std')
+        )
+    
+    def build_enhancer_summary(self, enhancer_stats):
+        """Format the per-enhancer overview table from build_enhancer_stats"""
+        if enhancer_stats.empty:
+            return pd.DataFrame()
+        
+        summary = pd.DataFrame({
+            'Chromosome': enhancer_stats['chr'],
+            'Start': enhancer_stats['start'].map('{:,}'.format),
+            'End': enhancer_stats['end'].map('{:,}'.format),
+            'Length (bp)': (enhancer_stats['end'] - enhancer_stats['start']).map('{:,}'.format),
+            'Cell Types': enhancer_stats['cell_types'],
+            'Mean Accessibility': enhancer_stats['mean'].map('{:.4f}'.format),
+            'Max Accessibility': enhancer_stats['max'].map('{:.4f}'.format)
+        }, index=enhancer_stats.index)
+        summary.index.name = 'Enhancer ID'
+        
+        return summary
+    
+    def build_top_cell_types(self, peak_data, n=5):
+        """Top n cell types by mean accessibility for every enhancer"""
+        if peak_data.empty:
+            return {}
+        
+        mean_scores = peak_data.groupby(['enhancer_id', 'cell_type'], observed=True)['accessibility_score'].mean()
+        top_scores = (mean_scores.sort_values(ascending=False)
+                      .groupby(level='enhancer_id', observed=True, sort=False)
+                      .head(n))
+        
+        top_cell_types = {}
+        for (enhancer_id, cell_type), score in top_scores.items():
+            top_cell_types.setdefault(enhancer_id, []).append((cell_type, float(score)))
+        
+        return top_cell_types
+    
+    def load_derived_data(self, enhancer_metadata, peak_data, hof_enhancers, data_key):
+        """Return filter options, enhancer stats and summary table, top cell types and imaging URLs,
+        reusing the on-disk sidecar when the input files are unchanged"""
+        cache_path = self.derived_cache_path(data_key)
+        
+        if cache_path and os.path.exists(cache_path):
+            try:
+                return self.read_derived_cache(cache_path)
+            except Exception as e:
+                st.warning(f"Ignoring unreadable derived data cache: {str(e)}")
+        
+        filter_options = self.build_filter_options(enhancer_metadata, peak_data, hof_enhancers)
+        enhancer_stats = self.build_enhancer_stats(peak_data)
+        enhancer_summary = self.build_enhancer_summary(enhancer_stats)
+        top_cell_types = self.build_top_cell_types(peak_data)
+        imaging_urls = self.build_imaging_urls(enhancer_metadata)
+        derived = DerivedData(filter_options, enhancer_stats, enhancer_summary, top_cell_types, imaging_urls)
+        
+        # The loaders return empty frames on failure; never persist the result of a failed load
+        if cache_path and not peak_data.empty and not enhancer_metadata.empty:
+            try:
+                self.write_derived_cache(cache_path, derived)
+            except Exception as e:
+                st.warning(f"Could not write derived data cache: {str(e)}")
+        
+        return derived
+    
+    def derived_cache_key(self):
+        """Key from the size and mtime of the input files (None if any is missing)"""
+        key_parts = [f"v{self.derived_cache_version}"]
+        for path in (self.csv_path, self.metadata_path):
+            if not os.path.exists(path):
+                return None
+            stat = os.stat(path)
+            key_parts.append(f"{path}:{stat.st_size}:{stat.st_mtime_ns}")
+        
+        return hashlib.sha1("|".join(key_parts).encode()).hexdigest()[:16]
+    
+    def derived_cache_path(self, data_key):
+        """Sidecar path for a key from derived_cache_key (None without a key)"""
+        if data_key is None:
+            return None
+        return os.path.join(self.cache_dir, f"derived_{data_key}.feather")
+    
+    def write_derived_cache(self, cache_path, derived):
+        """Persist the derived lookups as one zstd-compressed feather file"""
+        filter_options, enhancer_stats, enhancer_summary, top_cell_types, imaging_urls = derived
+        
+        # One row per enhancer; nested lists are stored as JSON strings
+        enhancer_ids = [str(enhancer_id) for enhancer_id in enhancer_stats.index]
+        df = pd.DataFrame({
+            'enhancer_id': enhancer_ids,
+            'top_cell_types': [json.dumps(top_cell_types.get(eid, [])) for eid in enhancer_ids],
+            'imaging_urls': [json.dumps(imaging_urls.get(eid, [])) for eid in enhancer_ids]
+        })
+        
+        # The stats and formatted summary tables share the enhancer rows; prefix their columns
+        for col in enhancer_stats.columns:
+            df[f"stats:{col}"] = enhancer_stats[col].to_numpy()
+        summary = enhancer_summary.reindex(enhancer_stats.index)
+        for col in summary.columns:
+            df[f"summary:{col}"] = summary[col].to_numpy()
+        
+        # Filter option lists are not per-enhancer, so they go in the schema metadata
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata({
+            **(table.schema.metadata or {}),
+            b'filter_options': json.dumps(filter_options._asdict()).encode()
+        })
+        
+        # Write to a temporary file first so readers never see a partial sidecar
+        os.makedirs(self.cache_dir, exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=self.cache_dir, suffix='.tmp', delete=False) as tmp_file:
+            tmp_path = tmp_file.name
+        try:
+            feather.write_feather(table, tmp_path, compression='zstd')
+            # NamedTemporaryFile creates the file 0600; keep the sidecar readable by other workers
+            os.chmod(tmp_path, 0o644)
+            os.replace(tmp_path, cache_path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+    
+    def read_derived_cache(self, cache_path):
+        """Load the derived lookups written by write_derived_cache"""
+        table = feather.read_table(cache_path, memory_map=True)
+        filter_options = FilterOptions(**json.loads(table.schema.metadata[b'filter_options']))
+        
+        df = table.to_pandas().set_index('enhancer_id')
+        stats_cols = [col for col in df.columns if col.startswith('stats:')]
+        enhancer_stats = df[stats_cols].rename(columns=lambda col: col[len('stats:'):])
+        summary_cols = [col for col in df.columns if col.startswith('summary:')]
+        enhancer_summary = (df[summary_cols]
+                            .rename(columns=lambda col: col[len('summary:'):])
+                            .rename_axis('Enhancer ID'))
+        top_cell_types = {
+            enhancer_id: [tuple(item) for item in json.loads(items)]
+            for enhancer_id, items in df['top_cell_types'].items()
+        }
+        imaging_urls = {
+            enhancer_id: [tuple(item) for item in json.loads(items)]
+            for enhancer_id, items in df['imaging_urls'].items()
+        }
+        
+        return DerivedData(filter_options, enhancer_stats, enhancer_summary, top_cell_types, imaging_urls)
+    
     def get_enhancer_summary(self, peak_data):
         """Generate comprehensive summary statistics for enhancers"""
         if peak_data.empty:
@@ -191,7 +482,7 @@ class DataProcessor:
         
         # Genomic span analysis
         if 'start' in peak_data.columns and 'end' in peak_data.columns:
-            enhancer_lengths = peak_data.groupby('enhancer_id').apply(
+            enhancer_lengths = peak_data.groupby('enhancer_id', observed=True).apply(
                 lambda x: x.iloc[0]['end'] - x.iloc[0]['start']
             )
             summary['mean_enhancer_length'] = enhancer_lengths.mean()
@@ -232,7 +523,7 @@ class DataProcessor:
             validation_results['is_valid'] = False
         
         # Check for data consistency
-        enhancer_coords = peak_data.groupby('enhancer_id')[['chr', 'start', 'end']].nunique()
+        enhancer_coords = peak_data.groupby('enhancer_id', observed=True)[['chr', 'start', 'end']].nunique()
         inconsistent_coords = enhancer_coords[(enhancer_coords > 1).any(axis=1)]
         if not inconsistent_coords.empty:
             validation_results['warnings'].append(
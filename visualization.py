@@ -19,14 +19,40 @@ class VisualizationGenerator:
             '#32CD32', '#FF69B4', '#00CED1', '#FF1493', '#00FF7F'
         ]
         
-        # Cell type specific color mapping for consistency
+        # Cell type specific color mapping for consistency (see assign_cell_type_colors)
         self.cell_type_colors = {}
+        
+        # Upper bound on x-points per track; wider tracks are binned server-side
+        self.max_track_points = 512
+    
+    def assign_cell_type_colors(self, cell_types: List[str]) -> None:
+        """Fix the color of each cell type from its position in the ordered list"""
+        self.cell_type_colors = {
+            cell_type: self.colors[i % len(self.colors)] for i, cell_type in enumerate(cell_types)
+        }
     
     def get_cell_type_color(self, cell_type: str, index: int) -> str:
         """Get consistent color for cell type"""
-        if cell_type not in self.cell_type_colors:
-            self.cell_type_colors[cell_type] = self.colors[len(self.cell_type_colors) % len(self.colors)]
-        return self.cell_type_colors[cell_type]
+        # The mapping is never mutated here, so a shared generator stays deterministic;
+        # cell types outside it fall back to a color derived from their index
+        if cell_type in self.cell_type_colors:
+            return self.cell_type_colors[cell_type]
+        return self.colors[index % len(self.colors)]
+    
+    def downsample_track(self, cell_data: pd.DataFrame, max_points: int) -> pd.DataFrame:
+        """Aggregate a track into at most max_points position bins (max accessibility per bin)"""
+        if len(cell_data) <= max_points:
+            return cell_data
+        
+        positions = cell_data['genomic_position'].to_numpy()
+        edges = np.linspace(positions.min(), positions.max(), max_points + 1)
+        bins = np.digitize(positions, edges[1:-1])
+        
+        # Keep the peak height of each bin so narrow peaks survive the aggregation
+        return (cell_data.groupby(bins)
+                .agg(genomic_position=('genomic_position', 'mean'),
+                     accessibility_score=('accessibility_score', 'max'))
+                .reset_index(drop=True))
     
     def create_peak_visualization(self, peak_data: pd.DataFrame, enhancer_id: str) -> go.Figure:
         """Create a pyGenomeTracks-style visualization for peak accessibility"""
@@ -35,16 +61,18 @@ class VisualizationGenerator:
             return self.create_empty_plot("No peak data available for visualization")
         
         # Get unique cell types and sort them numerically by their leading numbers
-        cell_types = peak_data['cell_type'].unique()
-        
-        # Custom sorting function to extract and sort by leading numbers
-        def extract_cell_type_number(cell_type):
-            import re
-            # Extract the leading number from cell type names like "11_CNU_HYa_GABA"
-            match = re.match(r'^(\d+)', str(cell_type))
-            return int(match.group(1)) if match else 999
-        
-        cell_types = sorted(cell_types, key=extract_cell_type_number)
+        if isinstance(peak_data['cell_type'].dtype, pd.CategoricalDtype) and peak_data['cell_type'].cat.ordered:
+            # Categories were put in numeric order at load time
+            cell_types = list(peak_data['cell_type'].cat.remove_unused_categories().cat.categories)
+        else:
+            # Custom sorting function to extract and sort by leading numbers
+            def extract_cell_type_number(cell_type):
+                import re
+                # Extract the leading number from cell type names like "11_CNU_HYa_GABA"
+                match = re.match(r'^(\d+)', str(cell_type))
+                return int(match.group(1)) if match else 999
+            
+            cell_types = sorted(peak_data['cell_type'].unique(), key=extract_cell_type_number)
         num_cell_types = len(cell_types)
         
         if num_cell_types == 0:
@@ -88,6 +116,12 @@ class VisualizationGenerator:
                     # Handle case where all positions are the same
                     cell_data['genomic_position'] = start_pos + total_length / 2
                 
+                # Peak marker threshold comes from the raw scores, not the binned maxima
+                high_threshold = cell_data['accessibility_score'].quantile(0.8)
+                
+                # Bound the number of points shipped to the browser for wide enhancers
+                cell_data = self.downsample_track(cell_data, self.max_track_points)
+                
                 # Get consistent color for this cell type
                 color = self.get_cell_type_color(cell_type, i-1)
                 
@@ -112,8 +146,8 @@ class VisualizationGenerator:
                     row=i, col=1
                 )
                 
-                # Add peak markers for high accessibility regions
-                high_accessibility = cell_data[cell_data['accessibility_score'] > cell_data['accessibility_score'].quantile(0.8)]
+                # Add peak markers for high accessibility regions (for binned tracks: bins whose peak clears the threshold)
+                high_accessibility = cell_data[cell_data['accessibility_score'] > high_threshold]
                 if not high_accessibility.empty:
                     fig.add_trace(
                         go.Scatter(
@@ -215,7 +249,7 @@ class VisualizationGenerator:
         
         # Calculate mean accessibility per enhancer per cell type
         comparison_data = (peak_data[peak_data['enhancer_id'].isin(enhancer_ids)]
-                          .groupby(['enhancer_id', 'cell_type'])['accessibility_score']
+                          .groupby(['enhancer_id', 'cell_type'], observed=True)['accessibility_score']
                           .mean()
                           .reset_index())
         
@@ -305,7 +339,7 @@ class VisualizationGenerator:
             )
         
         # 2. Bar chart of enhancer count by cell type
-        cell_type_counts = peak_data.groupby('cell_type')['enhancer_id'].nunique().head(15)
+        cell_type_counts = peak_data.groupby('cell_type', observed=True)['enhancer_id'].nunique().head(15)
         fig.add_trace(
             go.Bar(
                 x=cell_type_counts.index, 
@@ -318,7 +352,7 @@ class VisualizationGenerator:
         )
         
         # 3. Top enhancers by mean accessibility
-        mean_acc = peak_data.groupby('enhancer_id')['accessibility_score'].mean().nlargest(20)
+        mean_acc = peak_data.groupby('enhancer_id', observed=True)['accessibility_score'].mean().nlargest(20)
         fig.add_trace(
             go.Bar(
                 x=mean_acc.index, 
@@ -331,7 +365,7 @@ class VisualizationGenerator:
         )
         
         # 4. Genomic span analysis
-        genomic_info = peak_data.groupby('enhancer_id').agg({
+        genomic_info = peak_data.groupby('enhancer_id', observed=True).agg({
             'start': 'first',
             'end': 'first',
             'accessibility_score': 'mean'
@@ -389,7 +423,7 @@ class VisualizationGenerator:
             return self.create_empty_plot(f"No data available for cell type: {cell_type}")
         
         # Group by enhancer and calculate statistics
-        enhancer_stats = cell_data.groupby('enhancer_id').agg({
+        enhancer_stats = cell_data.groupby('enhancer_id', observed=True).agg({
             'accessibility_score': ['mean', 'max', 'std', 'count'],
             'chr': 'first',
             'start': 'first',